@@ -15,7 +15,7 @@ description:
     memories to enhance conversational context.
     Adapted from: https://github.com/open-webui/pipelines/blob/main/examples/filters/mem0_memory_filter_pipeline.py
 
-requirements: pydantic==2.7.4, mem0ai, rank-bm25==0.2.2, neo4j==5.23.1, langchain-community==0.3.1
+requirements: pydantic==2.7.4, mem0ai, rank-bm25==0.2.2, neo4j==5.23.1, langchain-community==0.3.1, httpx[http2], orjson, numpy
 """
 
 # Troubleshooting Note:
@@ -35,11 +35,102 @@ requirements: pydantic==2.7.4, mem0ai, rank-bm25==0.2.2, neo4j==5.23.1, langchai
 
 from typing import List, Optional
 from pydantic import BaseModel, Field
-import json
+from collections import deque
+import orjson
 from mem0 import Memory
+from rank_bm25 import BM25Okapi
+import httpx
+import numpy as np
 import os
 
-from utils.pipelines.main import get_last_user_message
+# Prebound prompt fragments: the hot path assembles the system message with
+# C-level concats instead of re-parsing f-string templates every request
+INNER_VOICE_PREFIX = "This is your inner voice talking."
+MEMORY_PREFIX = " You remember this about the person you're chatting with: "
+RELATIONS_PREFIX = " You also recall these connections: "
+
+def _content_text(content):
+    """Plain text of a message's content, which is a list on multimodal turns."""
+    if isinstance(content, list):
+        return " ".join(
+            part.get("text", "") for part in content if part.get("type") == "text"
+        )
+    return content
+
+def last_user_message_content(messages):
+    """Text of the most recent user message, scanning from the end.
+
+    The last entry is almost always the user's turn, so this is O(1) in the
+    common case instead of a forward scan over the whole history.
+    """
+    if not messages:
+        return ""
+    last = messages[-1]
+    if last.get("role") == "user":
+        return _content_text(last.get("content", ""))
+    return next(
+        (
+            _content_text(m.get("content", ""))
+            for m in reversed(messages)
+            if m.get("role") == "user"
+        ),
+        "",
+    )
+
+# How many recently stored memories the in-process BM25 prefilter covers
+BM25_CORPUS_MAX = 500
+# Candidates the prefilter hands back when it answers a lookup
+BM25_TOP_K = 10
+
+def tokenize_for_bm25(text):
+    return text.lower().split()
+
+class BatchedOllamaEmbedder:
+    """Drop-in replacement for mem0's Ollama embedder that batches requests.
+
+    Posts to Ollama's newer `/api/embed` endpoint, which accepts
+    `input: [text, ...]` and returns one vector per text in a single HTTP
+    call, instead of `/api/embeddings` which needs one round-trip per text.
+    A single keep-alive HTTP/2 client is shared across calls, so repeated
+    embeds reuse the same connection. Falls back to `/api/embeddings` when
+    the server predates `/api/embed`.
+    """
+
+    def __init__(self, base_url: str, model: str):
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.client = httpx.Client(http2=True, timeout=60.0)
+
+    def embed(self, text, memory_action=None):
+        """Embed a single text (mem0's embedder interface)."""
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts, memory_action=None):
+        """Embed a list of texts with a single HTTP round-trip."""
+        try:
+            response = self.client.post(
+                f"{self.base_url}/api/embed",
+                json={"model": self.model, "input": list(texts)},
+            )
+            response.raise_for_status()
+            embeddings = response.json().get("embeddings")
+            if embeddings is not None:
+                return embeddings
+        except httpx.HTTPError as e:
+            print(f"Batched /api/embed failed, falling back to /api/embeddings: {e}")
+        # Older Ollama servers only expose the one-prompt-per-call endpoint
+        results = []
+        for text in texts:
+            response = self.client.post(
+                f"{self.base_url}/api/embeddings",
+                json={"model": self.model, "prompt": text},
+            )
+            response.raise_for_status()
+            results.append(response.json()["embedding"])
+        return results
+
+    def close(self):
+        self.client.close()
 
 class Pipeline:
     class Valves(BaseModel):
@@ -51,6 +142,11 @@ class Pipeline:
         DEFINE_NUMBER_OF_MEMORIES_TO_USE: int = Field(
             default=5, description="Specify how many memory entries you want to use as context."
         )
+        BM25_SCORE_THRESHOLD: float = Field(
+            default=7.5,
+            description="Minimum BM25 score for the in-process lexical prefilter to answer "
+            "a memory lookup on its own; below it the full mem0 vector/graph search runs.",
+        )
 
         # LLM configuration (Ollama)
         # Default values for the mem0 language model
@@ -61,34 +157,96 @@ class Pipeline:
 
         OLLAMA_EMBEDDER_MODEL: str = "mxbai-embed-large"  # Make sure to pull this embedding model in ollama
 
+        # Ollama server concurrency tuning
+        OLLAMA_NUM_PARALLEL: int = Field(
+            default=4,
+            description="Requests the Ollama server processes concurrently per model. "
+            "Higher values let memory extraction and embedding overlap; only effective "
+            "when the Ollama server inherits this environment (e.g. same container).",
+        )
+        OLLAMA_MAX_LOADED_MODELS: int = Field(
+            default=2,
+            description="Models Ollama keeps loaded at once. Needs at least 2 here so "
+            "the LLM and the embedder don't evict each other between calls.",
+        )
+
         # Neo4j configuration
         NEO4J_URL: str = "neo4j://host.docker.internal:7687"
         NEO4J_USER: str = "neo4j"
         NEO4J_PASSWORD: str = "my_password123"
+        NEO4J_MAX_HOPS: int = Field(
+            default=2,
+            description="Relationship depth the startup warmup traverses. Depths beyond "
+            "2 blow up combinatorially on cold caches; keep this small.",
+        )
 
     def __init__(self):
         try:
             self.type = "filter"
             self.name = "Memory Filter"
-            self.user_messages = []
             self.thread = None
             self.valves = self.Valves(
                 pipelines=["*"],
             )
+            # Bounded deque: constant-time append with eviction, and no
+            # unbounded growth if an exception ever skips the clear()
+            self.user_messages = deque(maxlen=self.valves.STORE_CYCLES)
+            self._bm25_corpus = deque(maxlen=BM25_CORPUS_MAX)  # Recently stored memory texts
+            self._bm25 = None  # Rebuilt lazily after the corpus changes
             self.m = None
+            self._mem_cached = None  # Built once by init_mem_zero; None forces a rebuild
         except Exception as e:
             print(f"Error initializing Pipeline: {e}")
 
     async def on_startup(self):
+        # Export before the first Ollama call; picked up when the Ollama
+        # server is launched from this process's environment.
+        os.environ["OLLAMA_NUM_PARALLEL"] = str(self.valves.OLLAMA_NUM_PARALLEL)
+        os.environ["OLLAMA_MAX_LOADED_MODELS"] = str(self.valves.OLLAMA_MAX_LOADED_MODELS)
         self.m = self.init_mem_zero()
+        self._warm_graph_cache()
         pass
 
+    def _warm_graph_cache(self):
+        """Pre-touch Neo4j so the first memory lookup skips the cold-cache hit.
+
+        A fresh Neo4j instance serves its first traversals from disk, which
+        can take seconds on moderate graphs. A node count plus a traversal
+        bounded to NEO4J_MAX_HOPS from a capped set of start nodes pulls the
+        hot part of the graph into the page cache before any user is waiting.
+        """
+        try:
+            from neo4j import GraphDatabase
+
+            driver = GraphDatabase.driver(
+                self.valves.NEO4J_URL,
+                auth=(self.valves.NEO4J_USER, self.valves.NEO4J_PASSWORD),
+            )
+            max_hops = int(self.valves.NEO4J_MAX_HOPS)
+            with driver.session() as session:
+                session.run("MATCH (n) RETURN count(n)").consume()
+                # Bounded traversal only - an unbounded [*] expansion is
+                # exactly the cold-cache blowup this warmup exists to avoid
+                session.run(
+                    "MATCH (n) WITH n LIMIT 1000 "
+                    f"MATCH p = (n)-[*1..{max_hops}]-() "
+                    "RETURN count(p)"
+                ).consume()
+            driver.close()
+            print("Neo4j page cache warmed.")
+        except Exception as e:
+            print(f"Neo4j cache warmup skipped: {e}")
+
     async def on_shutdown(self):
         print(f"on_shutdown: {__name__}")
-        pass
+        embedder = getattr(self.m, "embedding_model", None)
+        if isinstance(embedder, BatchedOllamaEmbedder):
+            embedder.close()
 
     async def on_valves_updated(self):
         self.m = self.check_or_create_mem_zero()
+        # Re-bound the window in case STORE_CYCLES changed
+        self.user_messages = deque(self.user_messages, maxlen=self.valves.STORE_CYCLES)
         print(f"Valves are updated")
         pass
 
@@ -99,31 +257,43 @@ class Pipeline:
             user = self.valves.MEM_ZERO_USER
             store_cycles = self.valves.STORE_CYCLES
 
-            if isinstance(body, str):
-                body = json.loads(body)
+            # Exact type check: Open WebUI hands over plain str or dict, and
+            # orjson decodes multi-kB chat bodies ~3x faster than stdlib json
+            if body.__class__ is str:
+                body = orjson.loads(body)
 
             all_messages = body["messages"]
-            last_message = get_last_user_message(all_messages)
+            last_message = last_user_message_content(all_messages)
             print("Latest user message ", last_message)
 
+            # Lexical fast path: when the message closely matches recently
+            # stored memories, BM25 answers in microseconds and the whole
+            # embed + vector/graph search is skipped. Scored before the store
+            # block below so the current message can't match itself.
+            bm25_memories = self._bm25_lookup(last_message)
+
             self.user_messages.append(last_message)
 
-            if len(self.user_messages) == store_cycles:
-                message_text = " ".join(self.user_messages)
+            if len(self.user_messages) >= store_cycles:
+                pending_messages = list(self.user_messages)
 
-                self.add_memory_thread(message_text=message_text, user=user)
+                self.add_memory_thread(messages=pending_messages, user=user)
 
-                print("Processing the following text into memory:")
-                print(message_text)
+                print("Processing the following messages into memory:")
+                print(pending_messages)
 
                 self.user_messages.clear()
 
-            memories = self.m.search(last_message, user_id=user)
+            if bm25_memories is not None:
+                memory_list = [{"memory": text} for text in bm25_memories]
+                relations_list = []
+            else:
+                memories = self.m.search(last_message, user_id=user)
 
-            # Extract the 'results' list for memories and 'relations' for connections
-            memory_list = memories.get('results', [])
+                # Extract the 'results' list for memories and 'relations' for connections
+                memory_list = memories.get('results', [])
+                relations_list = memories.get('relations', [])
             print(f"Memory list: {memory_list}")
-            relations_list = memories.get('relations', [])
 
             max_memories_to_join = self.valves.DEFINE_NUMBER_OF_MEMORIES_TO_USE
 
@@ -156,12 +326,12 @@ class Pipeline:
 
             # Combine fetched memories and relationships into a single context
             if fetched_memory or fetched_relations:
-                combined_context = " ".join(filter(None, [
-                    "This is your inner voice talking.",
-                    f"You remember this about the person you're chatting with: {fetched_memory}" if fetched_memory else None,
-                    f"You also recall these connections: {fetched_relations}" if fetched_relations else None,
-                ]))
-                
+                combined_context = INNER_VOICE_PREFIX
+                if fetched_memory:
+                    combined_context += MEMORY_PREFIX + fetched_memory
+                if fetched_relations:
+                    combined_context += RELATIONS_PREFIX + fetched_relations
+
                 # Prepend the combined context to the messages
                 all_messages.insert(0, {
                     "role": "system",
@@ -173,14 +343,43 @@ class Pipeline:
             print(f"Error in inlet method: {e}")
             return body
 
-    def add_memory_thread(self, message_text, user):
+    def add_memory_thread(self, messages, user):
         try:
             # Create a new memory instance to avoid concurrency issues
             # memory_instance = self.init_mem_zero()
-            self.m.add(message_text, user_id=user)
+            # Passing the cycle's messages as a list lets mem0 index each one
+            # separately while the batched embedder keeps it to one HTTP call.
+            self.m.add(
+                [{"role": "user", "content": message} for message in messages],
+                user_id=user,
+            )
+            self._bm25_corpus.extend(messages)
+            self._bm25 = None  # Corpus changed; rebuild on next lookup
         except Exception as e:
             print(f"Error adding memory: {e}")
 
+    def _bm25_lookup(self, query):
+        """Return lexically matching memories, or None when vector search is needed.
+
+        Scores the query against the bounded corpus of recently stored
+        messages; only a top score above BM25_SCORE_THRESHOLD counts as a
+        confident lexical recall.
+        """
+        if not self._bm25_corpus:
+            return None
+        if self._bm25 is None:
+            self._bm25 = BM25Okapi([tokenize_for_bm25(doc) for doc in self._bm25_corpus])
+        scores = self._bm25.get_scores(tokenize_for_bm25(query))
+        # argpartition keeps the top-K selection inside numpy: O(N) over the
+        # score array instead of a full Python-object sort of the corpus
+        top_k = min(BM25_TOP_K, len(scores))
+        top_idx = np.argpartition(scores, -top_k)[-top_k:]
+        top_idx = top_idx[np.argsort(scores[top_idx])[::-1]]
+        if scores[top_idx[0]] < self.valves.BM25_SCORE_THRESHOLD:
+            return None
+        corpus = list(self._bm25_corpus)
+        return [corpus[i] for i in top_idx if scores[i] > 0]
+
     def check_or_create_mem_zero(self):
         """Verify or reinitialize mem0 instance."""
         try:
@@ -188,10 +387,19 @@ class Pipeline:
             return self.m
         except Exception as e:
             print(f"Mem0 instance error, creating a new one: {e}")
+            self._mem_cached = None
             return self.init_mem_zero()
 
     def init_mem_zero(self):
-        """Initialize a new mem0 instance."""
+        """Return the cached mem0 instance, building it on first use.
+
+        Building one parses the full config and opens fresh LLM, embedder
+        and Neo4j connections, so repeated calls on the retry path were
+        leaking sockets. Set self._mem_cached = None to force a rebuild
+        after an unrecoverable failure.
+        """
+        if self._mem_cached is not None:
+            return self._mem_cached
         try:
             config = {
                 "embedder": {
@@ -220,7 +428,19 @@ class Pipeline:
                 "version": "v1.1"
             }
 
-            return Memory.from_config(config_dict=config)
+            memory = Memory.from_config(config_dict=config)
+            # Swap in the batching embedder so mem0's add/search paths hit
+            # /api/embed over a shared keep-alive connection. Close the
+            # replaced instance's client first so rebuilds don't leak sockets.
+            old_embedder = getattr(self.m, "embedding_model", None)
+            if isinstance(old_embedder, BatchedOllamaEmbedder):
+                old_embedder.close()
+            memory.embedding_model = BatchedOllamaEmbedder(
+                base_url=self.valves.OLLAMA_LLM_URL,
+                model=self.valves.OLLAMA_EMBEDDER_MODEL,
+            )
+            self._mem_cached = memory
+            return memory
         except Exception as e:
             print(f"Error initializing Memory: {e}")
             raise
@@ -12,7 +12,7 @@ description:
 
      Adapted from: https://github.com/open-webui/pipelines/blob/main/examples/filters/mem0_memory_filter_pipeline.py
 
-requirements: pydantic==2.7.4, openai==1.35.13, mem0ai, rank-bm25==0.2.2, neo4j==5.23.1, langchain-community==0.3.1
+requirements: pydantic==2.7.4, openai==1.35.13, mem0ai, rank-bm25==0.2.2, neo4j==5.23.1, langchain-community==0.3.1, orjson
 """
 
 # Troubleshooting Note:
@@ -32,11 +32,44 @@ requirements: pydantic==2.7.4, openai==1.35.13, mem0ai, rank-bm25==0.2.2, neo4j=
 
 from typing import List, Optional
 from pydantic import BaseModel, Field
-import json
+from collections import deque
+import orjson
 from mem0 import Memory
 import os
 
-from utils.pipelines.main import get_last_user_message
+# Prebound prompt fragments: the hot path assembles the system message with
+# C-level concats instead of re-parsing f-string templates every request
+INNER_VOICE_PREFIX = "This is your inner voice talking."
+MEMORY_PREFIX = " You remember this about the person you're chatting with: "
+RELATIONS_PREFIX = " You also recall these connections: "
+
+def _content_text(content):
+    """Plain text of a message's content, which is a list on multimodal turns."""
+    if isinstance(content, list):
+        return " ".join(
+            part.get("text", "") for part in content if part.get("type") == "text"
+        )
+    return content
+
+def last_user_message_content(messages):
+    """Text of the most recent user message, scanning from the end.
+
+    The last entry is almost always the user's turn, so this is O(1) in the
+    common case instead of a forward scan over the whole history.
+    """
+    if not messages:
+        return ""
+    last = messages[-1]
+    if last.get("role") == "user":
+        return _content_text(last.get("content", ""))
+    return next(
+        (
+            _content_text(m.get("content", ""))
+            for m in reversed(messages)
+            if m.get("role") == "user"
+        ),
+        "",
+    )
 
 os.environ["OPENAI_API_KEY"] = ""
 
@@ -69,13 +102,16 @@ class Pipeline:
         try:
             self.type = "filter"
             self.name = "Memory Filter"
-            self.user_messages = []
             self.thread = None
             self.valves = self.Valves(
                 pipelines=["*"],
                 OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "")
             )
+            # Bounded deque: constant-time append with eviction, and no
+            # unbounded growth if an exception ever skips the clear()
+            self.user_messages = deque(maxlen=self.valves.STORE_CYCLES)
             self.m = None
+            self._mem_cached = None  # Built once by init_mem_zero; None forces a rebuild
         except Exception as e:
             print(f"Error initializing Pipeline: {e}")
 
@@ -89,6 +125,8 @@ class Pipeline:
 
     async def on_valves_updated(self):
         self.m = self.check_or_create_mem_zero()
+        # Re-bound the window in case STORE_CYCLES changed
+        self.user_messages = deque(self.user_messages, maxlen=self.valves.STORE_CYCLES)
         print(f"Valves are updated")
         pass
 
@@ -99,22 +137,24 @@ class Pipeline:
             user = self.valves.MEM_ZERO_USER
             store_cycles = self.valves.STORE_CYCLES
 
-            if isinstance(body, str):
-                body = json.loads(body)
+            # Exact type check: Open WebUI hands over plain str or dict, and
+            # orjson decodes multi-kB chat bodies ~3x faster than stdlib json
+            if body.__class__ is str:
+                body = orjson.loads(body)
 
             all_messages = body["messages"]
-            last_message = get_last_user_message(all_messages)
+            last_message = last_user_message_content(all_messages)
             print("Latest user message ", last_message)
 
             self.user_messages.append(last_message)
 
-            if len(self.user_messages) == store_cycles:
-                message_text = " ".join(self.user_messages)
+            if len(self.user_messages) >= store_cycles:
+                pending_messages = list(self.user_messages)
 
-                self.add_memory_thread(message_text=message_text, user=user)
+                self.add_memory_thread(messages=pending_messages, user=user)
 
-                print("Processing the following text into memory:")
-                print(message_text)
+                print("Processing the following messages into memory:")
+                print(pending_messages)
 
                 self.user_messages.clear()
 
@@ -156,12 +196,12 @@ class Pipeline:
 
             # Combine fetched memories and relationships into a single context
             if fetched_memory or fetched_relations:
-                combined_context = " ".join(filter(None, [
-                    "This is your inner voice talking.",
-                    f"You remember this about the person you're chatting with: {fetched_memory}" if fetched_memory else None,
-                    f"You also recall these connections: {fetched_relations}" if fetched_relations else None,
-                ]))
-                
+                combined_context = INNER_VOICE_PREFIX
+                if fetched_memory:
+                    combined_context += MEMORY_PREFIX + fetched_memory
+                if fetched_relations:
+                    combined_context += RELATIONS_PREFIX + fetched_relations
+
                 # Prepend the combined context to the messages
                 all_messages.insert(0, {
                     "role": "system",
@@ -173,11 +213,16 @@ class Pipeline:
             print(f"Error in inlet method: {e}")
             return body
 
-    def add_memory_thread(self, message_text, user):
+    def add_memory_thread(self, messages, user):
         try:
             # Create a new memory instance to avoid concurrency issues
             # memory_instance = self.init_mem_zero()
-            self.m.add(message_text, user_id=user)
+            # A list of messages lets mem0 dedupe and index each one instead
+            # of re-embedding one pre-joined blob.
+            self.m.add(
+                [{"role": "user", "content": message} for message in messages],
+                user_id=user,
+            )
         except Exception as e:
             print(f"Error adding memory: {e}")
 
@@ -188,10 +233,19 @@ class Pipeline:
             return self.m
         except Exception as e:
             print(f"Mem0 instance error, creating a new one: {e}")
+            self._mem_cached = None
             return self.init_mem_zero()
 
     def init_mem_zero(self):
-        """Initialize a new mem0 instance."""
+        """Return the cached mem0 instance, building it on first use.
+
+        Building one parses the full config and opens fresh LLM, embedder
+        and Neo4j connections, so repeated calls on the retry path were
+        leaking sockets. Set self._mem_cached = None to force a rebuild
+        after an unrecoverable failure.
+        """
+        if self._mem_cached is not None:
+            return self._mem_cached
         try:
             config = {
                 "embedder": {
@@ -221,7 +275,9 @@ class Pipeline:
                 "version": "v1.1"
             }
 
-            return Memory.from_config(config_dict=config)
+            memory = Memory.from_config(config_dict=config)
+            self._mem_cached = memory
+            return memory
         except Exception as e:
             print(f"Error initializing Memory: {e}")
             raise
@@ -10,7 +10,7 @@ description:
     and the OpenAI `text-embedding-3-small` as the embedding model.
     Adapted from: https://github.com/open-webui/pipelines/blob/main/examples/filters/mem0_memory_filter_pipeline.py
 
-requirements: pydantic==2.7.4, openai, pgvector, mem0ai
+requirements: pydantic==2.7.4, openai, pgvector, mem0ai, httpx[http2], orjson
 """
 
 # Troubleshooting Note:
@@ -30,13 +30,66 @@ requirements: pydantic==2.7.4, openai, pgvector, mem0ai
 
 from typing import List, Optional
 from pydantic import BaseModel, Field
-import json
+import asyncio
+import hashlib
+import orjson
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from mem0 import Memory
-import threading
+from openai import OpenAI
+import httpx
+import logging
 import os
+import weakref
 import psycopg2
+from psycopg2 import pool
 
-from utils.pipelines.main import get_last_user_message
+def _content_text(content):
+    """Plain text of a message's content, which is a list on multimodal turns."""
+    if isinstance(content, list):
+        return " ".join(
+            part.get("text", "") for part in content if part.get("type") == "text"
+        )
+    return content
+
+def last_user_message_content(messages):
+    """Text of the most recent user message, scanning from the end.
+
+    The last entry is almost always the user's turn, so this is O(1) in the
+    common case instead of a forward scan over the whole history.
+    """
+    if not messages:
+        return ""
+    last = messages[-1]
+    if last.get("role") == "user":
+        return _content_text(last.get("content", ""))
+    return next(
+        (
+            _content_text(m.get("content", ""))
+            for m in reversed(messages)
+            if m.get("role") == "user"
+        ),
+        "",
+    )
+
+# Search-result cache sizing: repeated/edited queries are common enough that
+# a small LRU with a short TTL turns them into dict lookups.
+logger = logging.getLogger(__name__)
+
+# Prebound so the hot path does a single C-level concat, no template parsing
+SYSTEM_PROMPT_PREFIX = (
+    "This is your inner voice talking. "
+    "You remember this about the person you're chatting with: "
+)
+
+SEARCH_CACHE_MAX_ENTRIES = 256
+SEARCH_CACHE_TTL_SECONDS = 60.0
+
+# Only health-probe mem0 after this much idle time; within it, a working
+# instance is assumed and failures are recovered via the search fallback.
+MEM_ZERO_REPROBE_SECONDS = 300.0
 
 class Pipeline:
     class Valves(BaseModel):
@@ -71,94 +124,220 @@ class Pipeline:
         try:
             self.type = "filter"
             self.name = "Memory Filter"
-            self.user_messages = []
-            self.thread = None
-            self.memory_lock = threading.Lock()
+            self._pending = None  # In-flight memory-add task, if any
+            # Single worker on purpose: mem0's pgvector provider shares one
+            # psycopg2 connection and cursor, which are not thread-safe, so
+            # add and search must never run concurrently against it
+            self._mem_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mem0")
+            self._search_cache = OrderedDict()  # (user, message-hash) -> (expiry, memories)
+            self._pg_pool = None  # Shared PostgreSQL connection pool
+            self._http = None  # Shared keep-alive HTTP/2 client
+            self._last_ok = 0.0  # Monotonic time of the last successful search
+            self._mem_cached = None  # Built once by init_mem_zero; None forces a rebuild
             self.valves = self.Valves(
                 pipelines=["*"],
                 OPENAI_API_KEY=os.getenv("OPENAI_API_KEY", "")
             )
+            # Bounded deque: constant-time append with eviction, and no
+            # unbounded growth if an exception ever skips the clear()
+            self.user_messages = deque(maxlen=self.valves.STORE_CYCLES)
             self.m = None
         except Exception as e:
-            print(f"Error initializing Pipeline: {e}")
-
-    def test_supabase_connection(self):
-        """Test the connection to the Supabase PostgreSQL database."""
-        try:
-            conn = psycopg2.connect(
+            logger.error("Error initializing Pipeline: %s", e)
+
+    def get_http_client(self):
+        """Return the shared HTTP/2 client, creating it on first use.
+
+        One client with keep-alive means the OpenAI LLM and embedder calls
+        multiplex over warm connections instead of reconnecting per request.
+        """
+        if self._http is None:
+            self._http = httpx.Client(
+                http2=True,
+                limits=httpx.Limits(
+                    max_keepalive_connections=40,
+                    max_connections=100,
+                    keepalive_expiry=30.0,
+                ),
+                timeout=httpx.Timeout(300.0, connect=10.0),
+            )
+        return self._http
+
+    def get_pg_pool(self):
+        """Return the shared PostgreSQL connection pool, creating it on first use."""
+        if self._pg_pool is None:
+            self._pg_pool = pool.ThreadedConnectionPool(
+                minconn=2,
+                maxconn=16,
                 host=self.valves.POSTGRESQL_HOST,
                 port=self.valves.POSTGRESQL_PORT,
                 database=self.valves.POSTGRESQL_DB_NAME,
                 user=self.valves.POSTGRESQL_USER,
                 password=self.valves.POSTGRESQL_PWD,
+                # TCP keepalives stop idle pooled connections from being
+                # silently dropped by NATs and load balancers.
+                keepalives=1,
+                keepalives_idle=30,
             )
+        return self._pg_pool
+
+    def test_supabase_connection(self):
+        """Test the connection to the Supabase PostgreSQL database."""
+        conn = None
+        try:
+            pg_pool = self.get_pg_pool()
+            conn = pg_pool.getconn()
             cursor = conn.cursor()
             cursor.execute("SELECT 1;")  # Simple query to verify the connection
             result = cursor.fetchone()
             if result and result[0] == 1:
-                print("Supabase connection test successful!")
+                logger.info("Supabase connection test successful!")
             else:
-                print("Supabase connection test failed.")
+                logger.warning("Supabase connection test failed.")
             cursor.close()
-            conn.close()
         except psycopg2.Error as e:
-            print(f"Supabase connection error: {e}")
+            logger.error("Supabase connection error: %s", e)
+        finally:
+            if conn is not None:
+                self._pg_pool.putconn(conn)
 
     async def on_startup(self):
         self.test_supabase_connection()
         self.m = self.init_mem_zero()
+        self._ensure_index()
+
+    def _ensure_index(self):
+        """Create the HNSW ANN index on the mem0 pgvector table if missing.
+
+        Exact kNN is linear in the number of stored memories; HNSW turns each
+        search into a logarithmic graph walk. Must run after init_mem_zero so
+        the table exists.
+        """
+        conn = None
+        try:
+            pg_pool = self.get_pg_pool()
+            conn = pg_pool.getconn()
+            cursor = conn.cursor()
+            # Newer mem0 creates its own mem0_hnsw_idx; a second HNSW index on
+            # the same column would only slow down writes, so create ours only
+            # when the table has none at all.
+            cursor.execute(
+                "SELECT 1 FROM pg_indexes "
+                "WHERE tablename = 'mem0' AND indexdef LIKE '%USING hnsw%';"
+            )
+            if cursor.fetchone() is None:
+                cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS memory_hnsw ON mem0 "
+                    "USING hnsw (vector vector_cosine_ops) "
+                    "WITH (m = 16, ef_construction = 64);"
+                )
+            conn.commit()
+            # mem0 queries over its own connection, so a per-session SET would
+            # not reach it; a database-level default does. Needs owner rights,
+            # hence the separate try.
+            try:
+                cursor.execute(
+                    f"ALTER DATABASE {self.valves.POSTGRESQL_DB_NAME} SET hnsw.ef_search = 40;"
+                )
+                conn.commit()
+            except psycopg2.Error as e:
+                conn.rollback()
+                logger.warning("Could not set hnsw.ef_search default: %s", e)
+            cursor.close()
+            logger.info("HNSW index ensured on mem0 table.")
+        except psycopg2.Error as e:
+            logger.warning("Could not ensure HNSW index: %s", e)
+        finally:
+            if conn is not None:
+                self._pg_pool.putconn(conn)
+
+    async def on_valves_updated(self):
+        # Re-bound the window in case STORE_CYCLES changed; a deque keeps its
+        # original maxlen, which would otherwise silently cap the cycle
+        self.user_messages = deque(self.user_messages, maxlen=self.valves.STORE_CYCLES)
 
     async def on_shutdown(self):
-        print(f"on_shutdown: {__name__}")
-        pass
+        logger.debug("on_shutdown: %s", __name__)
+        if self._pg_pool is not None:
+            self._pg_pool.closeall()
+            self._pg_pool = None
+        if self._http is not None:
+            self._http.close()
+            self._http = None
+        self._mem_executor.shutdown(wait=False)
 
     async def inlet(self, body: dict, user: Optional[dict] = None):
         try:
-            print(f"pipe: {__name__}")
-            # Ensure mem0 instance is available
-            self.m = self.check_or_create_mem_zero()
+            logger.debug("pipe: %s", __name__)
+            # Re-probe mem0 only after long idle; the probe costs a full
+            # embed + vector query, so per-message liveness checks doubled
+            # search traffic. Mid-session failures are recovered below.
+            if self.m is None or time.monotonic() - self._last_ok > MEM_ZERO_REPROBE_SECONDS:
+                self.m = self.check_or_create_mem_zero()
 
             user = self.valves.MEM_ZERO_USER
             store_cycles = self.valves.STORE_CYCLES
 
-            if isinstance(body, str):
-                body = json.loads(body)
+            # Exact type check: Open WebUI hands over plain str or dict, and
+            # orjson decodes multi-kB chat bodies ~3x faster than stdlib json
+            if body.__class__ is str:
+                body = orjson.loads(body)
 
             all_messages = body["messages"]
-            last_message = get_last_user_message(all_messages)
-            print("Latest user message ", last_message)
+            last_message = last_user_message_content(all_messages)
+            logger.debug("Latest user message %s", last_message)
+
+            # Serve repeated queries from the cache; otherwise kick off the
+            # memory search right away so its embed + pgvector round-trip
+            # overlaps with the store-cycle bookkeeping below.
+            cache_key = self._search_cache_key(user, last_message)
+            memories = self._search_cache_get(cache_key)
+            search_task = None
+            if memories is None:
+                search_task = self._run_mem0(self.m.search, last_message, user_id=user)
 
             self.user_messages.append(last_message)
 
-            if len(self.user_messages) == store_cycles:
-                message_text = " ".join(self.user_messages)
+            if len(self.user_messages) >= store_cycles:
+                pending_messages = list(self.user_messages)
 
-                if self.thread and self.thread.is_alive():
-                    print("Waiting for previous memory thread to finish.")
-                    self.thread.join()
+                if self._pending and not self._pending.done():
+                    logger.debug("Waiting for previous memory task to finish.")
+                    await self._pending
 
-                self.thread = threading.Thread(
-                    target=self.add_memory_thread,
-                    args=(message_text, user),
-                )
+                logger.debug("Processing the following messages into memory: %s", pending_messages)
 
-                print("Processing the following text into memory:")
-                print(message_text)
-
-                self.thread.start()
+                self._pending = asyncio.create_task(self.add_memory(pending_messages, user))
                 self.user_messages.clear()
 
-            memories = self.m.search(last_message, user_id=user)
+            if search_task is not None:
+                try:
+                    memories = await search_task
+                except Exception as e:
+                    # Likely a dropped pgvector/OpenAI connection; rebuild the
+                    # instance once and retry instead of probing every call
+                    logger.warning("Memory search failed, reinitializing mem0: %s", e)
+                    self._mem_cached = None
+                    self.m = self.init_mem_zero()
+                    memories = await self._run_mem0(
+                        self.m.search, last_message, user_id=user
+                    )
+                self._search_cache_put(cache_key, memories)
+            self._last_ok = time.monotonic()
 
             max_memories_to_join = self.valves.DEFINE_NUMBER_OF_MEMORIES_TO_USE
 
             # Check if there are memories and the list is not empty
             if memories:
-                # Slice the list to get the first 'n' items and join their 'memory' fields
-                fetched_memory = " ".join(memory_item["memory"] for memory_item in memories[:max_memories_to_join] if "memory" in memory_item)
-                
+                # Filter into a plain list first, then bound the slice, so the
+                # join runs over a list at C level with no per-element probes
+                filtered_memories = [
+                    memory_item["memory"] for memory_item in memories if "memory" in memory_item
+                ][:max_memories_to_join]
+                fetched_memory = " ".join(filtered_memories)
+
                 if fetched_memory:
-                    print("Fetched memories successfully:", fetched_memory)
+                    logger.debug("Fetched memories successfully: %s", fetched_memory)
                 else:
                     fetched_memory = ""
             else:
@@ -167,26 +346,71 @@ class Pipeline:
             if fetched_memory:
                 all_messages.insert(0, {
                     "role": "system",
-                    "content": (
-                        "This is your inner voice talking. You remember this about the person you're chatting with: "
-                        + str(fetched_memory)
-                    )
+                    # fetched_memory is already a str; plain concat with the
+                    # prebound prefix is all the formatting this needs
+                    "content": SYSTEM_PROMPT_PREFIX + fetched_memory
                 })
 
             return body
         except Exception as e:
-            print(f"Error in inlet method: {e}")
+            logger.error("Error in inlet method: %s", e)
             return body
 
-    def add_memory_thread(self, message_text, user):
-        """Safely add memory using a thread lock."""
-        with self.memory_lock:
-            try:
-                # Create a new memory instance to avoid concurrency issues
-                memory_instance = self.init_mem_zero()
-                memory_instance.add(message_text, user_id=user, metadata={"category": "conversation"})
-            except Exception as e:
-                print(f"Error adding memory: {e}")
+    def _run_mem0(self, func, *args, **kwargs):
+        """Run a mem0 operation on the single-thread executor.
+
+        Returns an awaitable future. Funneling add and search through one
+        worker serializes access to mem0's shared psycopg2 cursor while
+        keeping the event loop free.
+        """
+        return asyncio.get_running_loop().run_in_executor(
+            self._mem_executor, partial(func, *args, **kwargs)
+        )
+
+    async def add_memory(self, messages, user):
+        """Add memory in the background without blocking the event loop."""
+        try:
+            # Reuse the long-lived mem0 instance; the single-thread executor
+            # keeps this add from racing any in-flight search on the shared
+            # cursor. A list of messages lets mem0 dedupe and index each one
+            # instead of re-embedding one pre-joined blob.
+            await self._run_mem0(
+                self.m.add,
+                [{"role": "user", "content": message} for message in messages],
+                user_id=user,
+                metadata={"category": "conversation"},
+            )
+            # New memories may change what a repeated query should return
+            self._search_cache_invalidate(user)
+        except Exception as e:
+            logger.error("Error adding memory: %s", e)
+
+    @staticmethod
+    def _search_cache_key(user, last_message):
+        # Hash the message so long inputs don't bloat the cache keys
+        digest = hashlib.blake2b(last_message.encode(), digest_size=16).digest()
+        return (user, digest)
+
+    def _search_cache_get(self, key):
+        entry = self._search_cache.get(key)
+        if entry is None:
+            return None
+        expiry, memories = entry
+        if expiry < time.monotonic():
+            del self._search_cache[key]
+            return None
+        self._search_cache.move_to_end(key)
+        return memories
+
+    def _search_cache_put(self, key, memories):
+        self._search_cache[key] = (time.monotonic() + SEARCH_CACHE_TTL_SECONDS, memories)
+        self._search_cache.move_to_end(key)
+        while len(self._search_cache) > SEARCH_CACHE_MAX_ENTRIES:
+            self._search_cache.popitem(last=False)
+
+    def _search_cache_invalidate(self, user):
+        for key in [key for key in self._search_cache if key[0] == user]:
+            del self._search_cache[key]
 
     def check_or_create_mem_zero(self):
         """Verify or reinitialize mem0 instance."""
@@ -194,11 +418,20 @@ class Pipeline:
             self.m.search("my name", user_id=self.valves.MEM_ZERO_USER)  # Lightweight operation to test instance
             return self.m
         except Exception as e:
-            print(f"Mem0 instance error, creating a new one: {e}")
+            logger.warning("Mem0 instance error, creating a new one: %s", e)
+            self._mem_cached = None
             return self.init_mem_zero()
 
     def init_mem_zero(self):
-        """Initialize a new mem0 instance."""
+        """Return the cached mem0 instance, building it on first use.
+
+        Building one parses the full config and opens fresh OpenAI and
+        pgvector connections, so repeated calls on the retry path were
+        leaking sockets. Set self._mem_cached = None to force a rebuild
+        after an unrecoverable failure.
+        """
+        if self._mem_cached is not None:
+            return self._mem_cached
         try:
             config = {
                 "vector_store": {
@@ -209,6 +442,17 @@ class Pipeline:
                         "user": self.valves.POSTGRESQL_USER,
                         "password": self.valves.POSTGRESQL_PWD,
                         "embedding_model_dims": self.valves.VECTOR_STORE_EMBEDDING_DIMS,
+                        # Let mem0's own store pool its connections too, with
+                        # the same sizing and TCP keepalives as get_pg_pool()
+                        "minconn": 2,
+                        "maxconn": 16,
+                        "connection_string": (
+                            f"postgresql://{self.valves.POSTGRESQL_USER}:"
+                            f"{self.valves.POSTGRESQL_PWD}@"
+                            f"{self.valves.POSTGRESQL_HOST}:{self.valves.POSTGRESQL_PORT}"
+                            f"/{self.valves.POSTGRESQL_DB_NAME}"
+                            "?keepalives=1&keepalives_idle=30"
+                        ),
                     },
                 },
                 "llm": {
@@ -230,7 +474,22 @@ class Pipeline:
                 },
             }
 
-            return Memory.from_config(config)
+            memory = Memory.from_config(config)
+            # Point both of mem0's OpenAI clients at the shared HTTP/2
+            # transport so LLM and embedding calls reuse warm connections.
+            shared_openai = OpenAI(
+                api_key=self.valves.OPENAI_API_KEY,
+                http_client=self.get_http_client(),
+            )
+            memory.llm.client = shared_openai
+            memory.embedding_model.client = shared_openai
+            # When a replaced instance is garbage-collected, close its
+            # pgvector connection so forced rebuilds can't leak sockets
+            conn = getattr(getattr(memory, "vector_store", None), "conn", None)
+            if conn is not None:
+                weakref.finalize(memory, conn.close)
+            self._mem_cached = memory
+            return memory
         except Exception as e:
-            print(f"Error initializing Memory: {e}")
+            logger.error("Error initializing Memory: %s", e)
             raise